@@ -1,11 +1,12 @@
 import os
 from dotenv import load_dotenv
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker, declarative_base
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from sqlalchemy.orm import declarative_base
 from sqlalchemy.engine.url import make_url
 
-# Load .env (VS Code terminals sometimes don't inject env vars)
-load_dotenv()
+# Load .env (VS Code terminals sometimes don't inject env vars), unless the URL is already exported
+if "DATABASE_URL" not in os.environ:
+    load_dotenv()
 
 DATABASE_URL = os.getenv("DATABASE_URL")
 
@@ -13,20 +14,18 @@ DATABASE_URL = os.getenv("DATABASE_URL")
 url = make_url(DATABASE_URL)
 connect_args = {}
 
-engine = create_engine(
+# Async driver required (postgresql+psycopg / postgresql+asyncpg / sqlite+aiosqlite)
+engine = create_async_engine(
     DATABASE_URL,
     connect_args=connect_args,   # empty for Postgres
     pool_pre_ping=True,          # helps recycle stale connections
     pool_size=5,
     max_overflow=10,
 )
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+SessionLocal = async_sessionmaker(engine, expire_on_commit=False, autoflush=False)
 Base = declarative_base()
 
 
-def get_db():
-    db = SessionLocal()
-    try:
+async def get_db():
+    async with SessionLocal() as db:
         yield db
-    finally:
-        db.close()
@@ -1,13 +1,41 @@
 
+import os
+from contextlib import asynccontextmanager
+import orjson
 from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import JSONResponse, ORJSONResponse, Response
 from app.database import engine
 from app.models import coupon as coupon_model
 from app.routers import coupons as coupons_router
 
-# Create database tables
-coupon_model.Base.metadata.create_all(bind=engine)
+
+async def init_db():
+    # Create database tables
+    async with engine.begin() as conn:
+        await conn.run_sync(coupon_model.Base.metadata.create_all)
+
+
+class _JSONResponse(ORJSONResponse):
+    """orjson, falling back to the stdlib encoder for ints beyond 64 bits (orjson rejects them)"""
+
+    def render(self, content) -> bytes:
+        try:
+            return super().render(content)
+        except TypeError:
+            return JSONResponse.render(self, content)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Only on request: with --workers N every worker runs the lifespan, so
+    # production creates the schema once before launching (see README)
+    if os.getenv("APP_INIT_DB") == "1":
+        await init_db()
+    yield
+    await engine.dispose()
+
 
 app = FastAPI(
     title="Coupons Management API",
@@ -15,6 +43,8 @@ app = FastAPI(
     version="1.1.0",
     docs_url="/docs",
     redoc_url="/redoc",
+    lifespan=lifespan,
+    default_response_class=_JSONResponse,
 )
 
 # CORS - keep permissive for demo; restrict in prod
@@ -26,6 +56,9 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Compress larger bodies (e.g. /applicable-coupons with many promos); small ones aren't worth it
+app.add_middleware(GZipMiddleware, minimum_size=500, compresslevel=5)
+
 app.include_router(coupons_router.router)
 
 
@@ -34,14 +67,47 @@ def health():
     return {"status": "healthy"}
 
 
+def _error_prefix(status_code: int) -> bytes:
+    return b'{"error":{"status_code":%d,"detail":' % status_code
+
+
+# Envelope bytes for the common codes; only the detail is encoded per error
+_ERROR_PREFIXES = {code: _error_prefix(code) for code in (400, 404)}
+
+
 # Proper JSON error with correct status code
 @app.exception_handler(HTTPException)
 async def http_exception_handler(request: Request, exc: HTTPException):
-    return JSONResponse(
+    prefix = _ERROR_PREFIXES.get(exc.status_code) or _error_prefix(exc.status_code)
+    return Response(
+        content=prefix + orjson.dumps(exc.detail) + b"}}",
         status_code=exc.status_code,
-        content={"error": {"status_code": exc.status_code, "detail": exc.detail}},
+        media_type="application/json",
     )
 
+
+async def _init_db_once():
+    await init_db()
+    await engine.dispose()
+
+
 if __name__ == "__main__":
+    import sys
     import uvicorn
-    uvicorn.run("app.main:app", host="0.0.0.0", port=8000, reload=True)
+    if sys.argv[1:] == ["init-db"]:
+        # One-off schema creation before starting the workers
+        import asyncio
+        asyncio.run(_init_db_once())
+    elif os.getenv("DEV"):
+        uvicorn.run("app.main:app", host="0.0.0.0", port=8000, reload=True)
+    else:
+        # Compiled event loop + HTTP parser, one worker per core; "auto" picks
+        # uvloop where it's installed (not on Windows, see requirements.txt)
+        uvicorn.run(
+            "app.main:app",
+            host="0.0.0.0",
+            port=8000,
+            loop="auto",
+            http="httptools",
+            workers=os.cpu_count(),
+        )
@@ -1,5 +1,6 @@
 
 from sqlalchemy import Column, Integer, Enum, Boolean, JSON, DateTime, Index
+from sqlalchemy.dialects.postgresql import JSONB
 from app.database import Base
 
 CouponTypes = ("cart-wise", "product-wise", "bxgy")
@@ -10,12 +11,16 @@ class Coupon(Base):
 
     id = Column(Integer, primary_key=True, index=True)
     type = Column(Enum(*CouponTypes, name="coupon_type"), nullable=False, index=True)
-    details = Column(JSON, nullable=False)
+    # Stored pre-parsed (jsonb) on Postgres; plain JSON elsewhere
+    details = Column(JSON().with_variant(JSONB(), "postgresql"), nullable=False)
     is_active = Column(Boolean, default=True, nullable=False, index=True)
     expires_at = Column(DateTime(timezone=True), nullable=True)
     max_redemptions = Column(Integer, nullable=True)
     times_redeemed = Column(Integer, default=0, nullable=False)
+    # Bumped whenever type/details change; keys the compiled-coupon cache
+    version = Column(Integer, default=1, server_default="1", nullable=False)
 
     __table_args__ = (
         Index("ix_coupons_active_type", "is_active", "type"),
+        Index("ix_coupons_live", "is_active", "expires_at", "times_redeemed"),
     )
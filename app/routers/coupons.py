@@ -1,159 +1,192 @@
 
 from fastapi import APIRouter, Depends, HTTPException, Body
-from sqlalchemy.orm import Session
-from typing import List, Dict
-from decimal import Decimal
+from fastapi.responses import Response
+from pydantic import TypeAdapter
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import Callable, Dict, List, Tuple
+from typing_extensions import TypedDict
 from app.database import get_db
 from app.schemas.coupon import (
-    CouponCreate, CouponUpdate, CouponResponse, Cart, ApplicableCouponsResponse, ApplicableCoupon,
-    ApplyCouponResponse, UpdatedCart, CartItemWithDiscount
+    CouponCreate, CouponUpdate, CouponResponse, Cart, ApplicableCouponsResponse, ApplyCouponResponse
 )
 from app.services.coupon_service import CouponService
-from app.services.discount_calculator import DiscountCalculator, D, round2
+from app.models.coupon import Coupon
+from app.services.discount_calculator import DiscountCalculator, CartIndex, from_cents
 
 router = APIRouter(prefix="", tags=["coupons"])
 
 
+# Plain-dict mirrors of the response models: the hot endpoints build dicts and
+# serialize them in one dump_json call instead of allocating a model per row.
+# response_model stays on the routes for the OpenAPI docs.
+class _ApplicableCouponRow(TypedDict):
+    coupon_id: int
+    type: str
+    discount: float
+
+
+class _ApplicableCouponsRow(TypedDict):
+    applicable_coupons: List[_ApplicableCouponRow]
+
+
+class _CartItemRow(TypedDict):
+    product_id: int
+    quantity: int
+    price: float
+    total_discount: float
+
+
+class _UpdatedCartRow(TypedDict):
+    items: List[_CartItemRow]
+    total_price: float
+    total_discount: float
+    final_price: float
+
+
+class _ApplyCouponRow(TypedDict):
+    updated_cart: _UpdatedCartRow
+
+
+_APPLICABLE_ADAPTER = TypeAdapter(_ApplicableCouponsRow)
+_APPLY_ADAPTER = TypeAdapter(_ApplyCouponRow)
+
+
 @router.post("/coupons", response_model=CouponResponse, status_code=201)
-def create_coupon(coupon: CouponCreate, db: Session = Depends(get_db)):
-    created = CouponService.create_coupon(db, coupon)
+async def create_coupon(coupon: CouponCreate, db: AsyncSession = Depends(get_db)):
+    created = await CouponService.create_coupon(db, coupon)
     return created
 
 
 @router.get("/coupons", response_model=List[CouponResponse])
-def list_coupons(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
-    return CouponService.get_coupons(db, skip, limit)
+async def list_coupons(skip: int = 0, limit: int = 100, db: AsyncSession = Depends(get_db)):
+    return await CouponService.get_coupons(db, skip, limit)
 
 
 @router.get("/coupons/{coupon_id}", response_model=CouponResponse)
-def get_coupon(coupon_id: int, db: Session = Depends(get_db)):
-    c = CouponService.get_coupon(db, coupon_id)
+async def get_coupon(coupon_id: int, db: AsyncSession = Depends(get_db)):
+    c = await CouponService.get_coupon(db, coupon_id)
     if not c:
         raise HTTPException(status_code=404, detail="Coupon not found")
     return c
 
 
 @router.put("/coupons/{coupon_id}", response_model=CouponResponse)
-def update_coupon(coupon_id: int, payload: CouponUpdate, db: Session = Depends(get_db)):
-    updated = CouponService.update_coupon(db, coupon_id, payload)
+async def update_coupon(coupon_id: int, payload: CouponUpdate, db: AsyncSession = Depends(get_db)):
+    updated = await CouponService.update_coupon(db, coupon_id, payload)
     if not updated:
         raise HTTPException(status_code=404, detail="Coupon not found")
     return updated
 
 
 @router.delete("/coupons/{coupon_id}", status_code=204)
-def delete_coupon(coupon_id: int, db: Session = Depends(get_db)):
-    ok = CouponService.delete_coupon(db, coupon_id)
+async def delete_coupon(coupon_id: int, db: AsyncSession = Depends(get_db)):
+    ok = await CouponService.delete_coupon(db, coupon_id)
     if not ok:
         raise HTTPException(status_code=404, detail="Coupon not found")
     return
 
 
 @router.post("/applicable-coupons", response_model=ApplicableCouponsResponse)
-def get_applicable_coupons(body: Dict = Body(...), db: Session = Depends(get_db)):
+async def get_applicable_coupons(body: Dict = Body(...), db: AsyncSession = Depends(get_db)):
     cart_data = body.get("cart", body)
     cart = Cart(**cart_data)
+    index = DiscountCalculator.index_cart(cart)
 
-    applicable = []
-    for coupon in CouponService.get_active_coupons(db):
-        c_resp = CouponResponse.model_validate(coupon)
-        if DiscountCalculator.is_coupon_applicable(cart, c_resp):
-            disc = DiscountCalculator.calculate_discount(cart, c_resp)
-            applicable.append(ApplicableCoupon(coupon_id=coupon.id, type=coupon.type, discount=float(disc)))
-    return ApplicableCouponsResponse(applicable_coupons=applicable)
+    applicable: List[_ApplicableCouponRow] = []
+    for coupon in await CouponService.get_active_coupons(db):
+        disc = DiscountCalculator.compile_coupon(coupon)(index)
+        if disc is not None:
+            applicable.append({"coupon_id": coupon.id, "type": coupon.type, "discount": from_cents(disc)})
+    return Response(
+        content=_APPLICABLE_ADAPTER.dump_json({"applicable_coupons": applicable}),
+        media_type="application/json",
+    )
 
 
 @router.post("/apply-coupon/{coupon_id}", response_model=ApplyCouponResponse)
-def apply_coupon(coupon_id: int, cart: Cart, db: Session = Depends(get_db)):
-    c = CouponService.get_coupon(db, coupon_id)
+async def apply_coupon(coupon_id: int, cart: Cart, db: AsyncSession = Depends(get_db)):
+    c = await CouponService.get_coupon(db, coupon_id)
     if not c:
         raise HTTPException(status_code=404, detail="Coupon not found")
     CouponService.ensure_redeemable(c)
-    c_resp = CouponResponse.model_validate(c)
-
-    # Calculate discounts and construct updated cart
-    total_price = DiscountCalculator.calculate_cart_total(cart)
-    total_discount = Decimal(0)
-
-    items_map = {it.product_id: it for it in cart.items}
-    free_additions: Dict[int, int] = {}
-
-    if c_resp.type == 'cart-wise':
-        total_discount = DiscountCalculator.calculate_cart_wise_discount(cart, c_resp.details)
-        # distribute proportionally with round-to-sum
-        items_with_discount = []
-        subtotal = total_price
-        running = Decimal(0)
-        for idx, item in enumerate(cart.items, start=1):
-            proportion = (D(item.quantity) * D(item.price)) / subtotal if subtotal > 0 else Decimal(0)
-            # For last item, adjust to ensure sum equals total_discount
-            if idx < len(cart.items):
-                item_disc = round2(total_discount * proportion)
-                running += item_disc
-            else:
-                item_disc = round2(total_discount - running)
-            items_with_discount.append(CartItemWithDiscount(
-                product_id=item.product_id,
-                quantity=item.quantity,
-                price=item.price,
-                total_discount=float(item_disc)
-            ))
-    elif c_resp.type == 'product-wise':
-        total_discount = DiscountCalculator.calculate_product_wise_discount(cart, c_resp.details)
-        target_id = c_resp.details.get('product_id')
-        items_with_discount = []
-        for item in cart.items:
-            item_disc = Decimal(0)
-            if item.product_id == target_id:
-                product_total = D(item.quantity) * D(item.price)
-                if total_discount > product_total:
-                    item_disc = product_total
-                else:
-                    item_disc = total_discount
-            items_with_discount.append(CartItemWithDiscount(
-                product_id=item.product_id,
-                quantity=item.quantity,
-                price=item.price,
-                total_discount=float(round2(item_disc))
-            ))
-    elif c_resp.type == 'bxgy':
-        total_discount, free_items = DiscountCalculator.calculate_bxgy_discount(cart, c_resp.details)
-        # Add free quantities (even if not present originally), with price 0 for added items
-        for pid, free_qty in free_items.items():
-            if pid in items_map:
-                items_map[pid].quantity += free_qty
-            else:
-                free_additions[pid] = free_qty
-
-        items_with_discount = []
-        for item in cart.items:
-            disc = Decimal(0)
-            if item.product_id in free_items:
-                disc = D(free_items[item.product_id]) * D(item.price)
-            items_with_discount.append(CartItemWithDiscount(
-                product_id=item.product_id,
-                quantity=item.quantity,
-                price=item.price,
-                total_discount=float(round2(disc))
-            ))
-        # Include newly added free items at price 0
-        for pid, qty in free_additions.items():
-            items_with_discount.append(CartItemWithDiscount(
-                product_id=pid, quantity=qty, price=0.0, total_discount=0.0
-            ))
-    else:
-        raise HTTPException(status_code=400, detail="Unsupported coupon type")
 
-    final_total_discount = float(round2(total_discount))
-    total_price_float = float(round2(total_price))
-    final_price = total_price_float - final_total_discount
+    # Calculate discounts (integer cents) and construct updated cart
+    index = DiscountCalculator.index_cart(cart)
+    updated_cart = _build_updated_cart(index, c)
 
     # Increment redemption count
-    CouponService.increment_redemption(db, c)
-
-    return ApplyCouponResponse(updated_cart=UpdatedCart(
-        items=items_with_discount,
-        total_price=total_price_float,
-        total_discount=final_total_discount,
-        final_price=float(round2(Decimal(final_price)))
-    ))
+    await CouponService.increment_redemption(db, c)
+
+    return Response(
+        content=_APPLY_ADAPTER.dump_json({"updated_cart": updated_cart}),
+        media_type="application/json",
+    )
+
+
+# (total discount, per-item discounts, per-item quantities, free items added to the cart)
+_Staged = Tuple[int, List[int], List[int], List[_CartItemRow]]
+
+
+def _stage_cart_wise(index: CartIndex, coupon: Coupon) -> _Staged:
+    total_discount = DiscountCalculator.calculate_discount(index, coupon)
+    # distribute proportionally with round-to-sum (last item takes the remainder)
+    discounts = DiscountCalculator.distribute(index, total_discount)
+    return total_discount, discounts, index.arrays.qtys.tolist(), []
+
+
+def _stage_product_wise(index: CartIndex, coupon: Coupon) -> _Staged:
+    arrays = index.arrays
+    quantities = arrays.qtys.tolist()
+    total_discount = DiscountCalculator.calculate_discount(index, coupon)
+    target_id = coupon.details.get('product_id')
+    discounts = [
+        min(total_discount, qty * price) if pid == target_id else 0
+        for pid, qty, price in zip(arrays.pids.tolist(), quantities, arrays.prices.tolist())
+    ]
+    return total_discount, discounts, quantities, []
+
+
+def _stage_bxgy(index: CartIndex, coupon: Coupon) -> _Staged:
+    arrays = index.arrays
+    product_ids, quantities = arrays.pids.tolist(), arrays.qtys.tolist()
+    total_discount, free_items = DiscountCalculator.calculate_bxgy_discount(index, coupon.details)
+    discounts = [free_items.get(pid, 0) * price for pid, price in zip(product_ids, arrays.prices.tolist())]
+    # Add free quantities to the last occurrence of each product; items not in
+    # the cart are added at price 0
+    last_index = {pid: idx for idx, pid in enumerate(product_ids)}
+    free_additions: List[_CartItemRow] = []
+    for pid, free_qty in free_items.items():
+        if pid in last_index:
+            quantities[last_index[pid]] += free_qty
+        else:
+            free_additions.append({"product_id": pid, "quantity": free_qty, "price": 0.0, "total_discount": 0.0})
+    return total_discount, discounts, quantities, free_additions
+
+
+_STAGERS: Dict[str, Callable[[CartIndex, Coupon], _Staged]] = {
+    'cart-wise': _stage_cart_wise,
+    'product-wise': _stage_product_wise,
+    'bxgy': _stage_bxgy,
+}
+
+
+def _build_updated_cart(index: CartIndex, coupon: Coupon) -> _UpdatedCartRow:
+    """Stage per-item discounts for the coupon type, then build the response rows in one pass"""
+    stage = _STAGERS.get(coupon.type)
+    if stage is None:
+        raise HTTPException(status_code=400, detail="Unsupported coupon type")
+    total_discount, discounts, quantities, free_additions = stage(index, coupon)
+    total_price = index.cart_total_cents
+
+    items_with_discount: List[_CartItemRow] = [
+        {"product_id": item.product_id, "quantity": qty, "price": item.price, "total_discount": from_cents(disc)}
+        for item, qty, disc in zip(index.cart.items, quantities, discounts)
+    ]
+    items_with_discount.extend(free_additions)
+
+    return {
+        "items": items_with_discount,
+        "total_price": from_cents(total_price),
+        "total_discount": from_cents(total_discount),
+        "final_price": from_cents(total_price - total_discount),
+    }
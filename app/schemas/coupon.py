@@ -1,5 +1,5 @@
 from pydantic import BaseModel, Field, ConfigDict
-from typing import List, Dict, Any, Optional, Union
+from typing import List, Dict, Any, Optional, Union, Literal
 from datetime import datetime
 
 
@@ -7,13 +7,18 @@ from datetime import datetime
 class CartWiseDetails(BaseModel):
     threshold: float = Field(..., gt=0, description="Minimum cart value required")
     discount: float = Field(..., gt=0, description="Discount percentage or fixed amount")
-    discount_type: str = Field(default="percentage", description="'percentage' or 'fixed'")
+    discount_type: Literal["percentage", "fixed"] = Field(default="percentage", description="'percentage' or 'fixed'")
+
+    # JSON accepts Infinity/NaN; amounts must be finite to convert to cents
+    model_config = ConfigDict(allow_inf_nan=False)
 
 
 class ProductWiseDetails(BaseModel):
     product_id: int = Field(..., gt=0)
     discount: float = Field(..., gt=0)
-    discount_type: str = Field(default="percentage", description="'percentage' or 'fixed'")
+    discount_type: Literal["percentage", "fixed"] = Field(default="percentage", description="'percentage' or 'fixed'")
+
+    model_config = ConfigDict(allow_inf_nan=False)
 
 
 class BuyProduct(BaseModel):
@@ -27,8 +32,8 @@ class GetProduct(BaseModel):
 
 
 class BxGyDetails(BaseModel):
-    buy_products: List[BuyProduct]
-    get_products: List[GetProduct]
+    buy_products: List[BuyProduct] = Field(..., min_length=1)
+    get_products: List[GetProduct] = Field(..., min_length=1)
     repetition_limit: int = Field(default=1, gt=0)
 
 
@@ -63,8 +68,8 @@ class CouponResponse(BaseModel):
     max_redemptions: Optional[int] = None
     times_redeemed: int
 
-    # Pydantic v2 style config (replaces class Config)
-    model_config = ConfigDict(from_attributes=True)
+    # Pydantic v2 style config (replaces class Config); frozen since instances may be shared
+    model_config = ConfigDict(from_attributes=True, frozen=True)
 
 
 # Cart related schemas
@@ -73,10 +78,14 @@ class CartItem(BaseModel):
     quantity: int = Field(..., gt=0)
     price: float = Field(..., gt=0, description="Price per unit")
 
+    model_config = ConfigDict(frozen=True)
+
 
 class Cart(BaseModel):
     items: List[CartItem]
 
+    model_config = ConfigDict(frozen=True)
+
 
 # Response schemas for coupon application
 class ApplicableCoupon(BaseModel):
@@ -1,17 +1,46 @@
 
-from sqlalchemy.orm import Session
-from typing import List, Optional
+from sqlalchemy import select, update, or_
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import Any, Dict, List, NamedTuple, Optional, Type
 from datetime import datetime, timezone
+from cachetools import TTLCache
 from fastapi import HTTPException
+from pydantic import BaseModel, ValidationError
 from app.models.coupon import Coupon
-from app.schemas.coupon import CouponCreate, CouponUpdate
+from app.schemas.coupon import CouponCreate, CouponUpdate, CartWiseDetails, ProductWiseDetails, BxGyDetails
+from app.services.discount_calculator import DiscountCalculator
+
+
+class ActiveCoupon(NamedTuple):
+    """Detached view of a live coupon; all the calculator needs is type and details"""
+    id: int
+    version: int
+    type: str
+    details: Dict[str, Any]
+    expires_at: Optional[datetime]
+
+
+# Details schema per coupon type; strict so "10" is not silently accepted as 10
+_DETAILS_MODELS: Dict[str, Type[BaseModel]] = {
+    "cart-wise": CartWiseDetails,
+    "product-wise": ProductWiseDetails,
+    "bxgy": BxGyDetails,
+}
+
+# Active coupons are read on every cart view but change rarely; keep the
+# live set in-process for a short TTL and drop it on any write.
+_ACTIVE_CACHE_KEY = "active"
+_active_cache: TTLCache = TTLCache(maxsize=1, ttl=30)
+# Bumped on every invalidation; a read that started before a write must not
+# store its (older) result after the write has cleared the cache
+_active_generation = 0
 
 
 class CouponService:
     """Service class for CRUD operations on coupons"""
 
     @staticmethod
-    def create_coupon(db: Session, coupon_data: CouponCreate) -> Coupon:
+    async def create_coupon(db: AsyncSession, coupon_data: CouponCreate) -> Coupon:
         CouponService._validate_coupon_details(coupon_data.type, coupon_data.details)
         db_coupon = Coupon(
             type=coupon_data.type,
@@ -21,29 +50,51 @@ class CouponService:
             max_redemptions=coupon_data.max_redemptions,
         )
         db.add(db_coupon)
-        db.commit()
-        db.refresh(db_coupon)
+        await db.commit()
+        CouponService.invalidate_active_coupons()
         return db_coupon
 
     @staticmethod
-    def get_coupon(db: Session, coupon_id: int) -> Optional[Coupon]:
-        return db.query(Coupon).filter(Coupon.id == coupon_id).first()
+    async def get_coupon(db: AsyncSession, coupon_id: int) -> Optional[Coupon]:
+        result = await db.execute(select(Coupon).where(Coupon.id == coupon_id))
+        return result.scalar_one_or_none()
 
     @staticmethod
-    def get_coupons(db: Session, skip: int = 0, limit: int = 100) -> List[Coupon]:
+    async def get_coupons(db: AsyncSession, skip: int = 0, limit: int = 100) -> List[Coupon]:
         limit = min(max(limit, 1), 500)
-        return db.query(Coupon).offset(skip).limit(limit).all()
+        result = await db.execute(select(Coupon).offset(skip).limit(limit))
+        return list(result.scalars().all())
 
     @staticmethod
-    def get_active_coupons(db: Session) -> List[Coupon]:
+    async def get_active_coupons(db: AsyncSession) -> List[ActiveCoupon]:
         now = datetime.now(timezone.utc)
-        q = db.query(Coupon).filter(Coupon.is_active == True)
-        # filter out expired
-        return [c for c in q.all() if (c.expires_at is None or c.expires_at > now) and (c.max_redemptions is None or c.times_redeemed < c.max_redemptions)]
+        cached = _active_cache.get(_ACTIVE_CACHE_KEY)
+        if cached is None:
+            generation = _active_generation
+            stmt = select(Coupon).where(
+                Coupon.is_active.is_(True),
+                or_(Coupon.expires_at.is_(None), Coupon.expires_at > now),
+                or_(Coupon.max_redemptions.is_(None), Coupon.times_redeemed < Coupon.max_redemptions),
+            )
+            result = await db.execute(stmt)
+            cached = [ActiveCoupon(c.id, c.version, c.type, c.details, c.expires_at) for c in result.scalars().all()]
+            if generation == _active_generation:
+                _active_cache[_ACTIVE_CACHE_KEY] = cached
+            return cached
+        # a coupon may lapse while cached; redemptions already clear the cache
+        if any(c.expires_at is not None and c.expires_at <= now for c in cached):
+            return [c for c in cached if c.expires_at is None or c.expires_at > now]
+        return cached
 
     @staticmethod
-    def update_coupon(db: Session, coupon_id: int, coupon_data: CouponUpdate) -> Optional[Coupon]:
-        db_coupon = db.query(Coupon).filter(Coupon.id == coupon_id).first()
+    def invalidate_active_coupons() -> None:
+        global _active_generation
+        _active_generation += 1
+        _active_cache.clear()
+
+    @staticmethod
+    async def update_coupon(db: AsyncSession, coupon_id: int, coupon_data: CouponUpdate) -> Optional[Coupon]:
+        db_coupon = await CouponService.get_coupon(db, coupon_id)
         if not db_coupon:
             return None
 
@@ -54,6 +105,8 @@ class CouponService:
 
         db_coupon.type = final_type
         db_coupon.details = final_details
+        # Incremented in SQL so concurrent updates each get their own version
+        db_coupon.version = Coupon.version + 1
         if coupon_data.is_active is not None:
             db_coupon.is_active = coupon_data.is_active
         if coupon_data.expires_at is not None:
@@ -61,70 +114,52 @@ class CouponService:
         if coupon_data.max_redemptions is not None:
             db_coupon.max_redemptions = coupon_data.max_redemptions
 
-        db.commit()
-        db.refresh(db_coupon)
+        await db.commit()
+        CouponService.invalidate_active_coupons()
         return db_coupon
 
     @staticmethod
-    def delete_coupon(db: Session, coupon_id: int) -> bool:
-        db_coupon = db.query(Coupon).filter(Coupon.id == coupon_id).first()
+    async def delete_coupon(db: AsyncSession, coupon_id: int) -> bool:
+        db_coupon = await CouponService.get_coupon(db, coupon_id)
         if not db_coupon:
             return False
-        db.delete(db_coupon)
-        db.commit()
+        await db.delete(db_coupon)
+        await db.commit()
+        CouponService.invalidate_active_coupons()
+        DiscountCalculator.evict_compiled(coupon_id)
         return True
 
     @staticmethod
-    def increment_redemption(db: Session, coupon: Coupon) -> None:
-        coupon.times_redeemed += 1
-        db.commit()
-        db.refresh(coupon)
+    async def increment_redemption(db: AsyncSession, coupon: Coupon) -> None:
+        # Single conditional UPDATE so concurrent applies can't overshoot max_redemptions;
+        # rowcount rather than RETURNING, which MySQL doesn't support for UPDATE
+        stmt = (
+            update(Coupon)
+            .where(
+                Coupon.id == coupon.id,
+                or_(Coupon.max_redemptions.is_(None), Coupon.times_redeemed < Coupon.max_redemptions),
+            )
+            .values(times_redeemed=Coupon.times_redeemed + 1)
+        )
+        result = await db.execute(stmt)
+        if result.rowcount == 0:
+            await db.rollback()
+            raise HTTPException(status_code=400, detail="Coupon redemption limit reached")
+        await db.commit()
+        CouponService.invalidate_active_coupons()
 
     @staticmethod
     def _validate_coupon_details(coupon_type: str, details: dict) -> None:
-        if coupon_type == 'cart-wise':
-            required_fields = ['threshold', 'discount']
-            for field in required_fields:
-                if field not in details:
-                    raise HTTPException(status_code=400, detail=f"Missing required field '{field}' for cart-wise coupon")
-                if not isinstance(details[field], (int, float)) or details[field] <= 0:
-                    raise HTTPException(status_code=400, detail=f"Field '{field}' must be a positive number")
-            if 'discount_type' in details and details['discount_type'] not in ('percentage', 'fixed'):
-                raise HTTPException(status_code=400, detail="discount_type must be 'percentage' or 'fixed'")
-        elif coupon_type == 'product-wise':
-            required_fields = ['product_id', 'discount']
-            for field in required_fields:
-                if field not in details:
-                    raise HTTPException(status_code=400, detail=f"Missing required field '{field}' for product-wise coupon")
-            if not isinstance(details['product_id'], int) or details['product_id'] <= 0:
-                raise HTTPException(status_code=400, detail="product_id must be a positive integer")
-            if not isinstance(details['discount'], (int, float)) or details['discount'] <= 0:
-                raise HTTPException(status_code=400, detail="discount must be a positive number")
-            if 'discount_type' in details and details['discount_type'] not in ('percentage', 'fixed'):
-                raise HTTPException(status_code=400, detail="discount_type must be 'percentage' or 'fixed'")
-        elif coupon_type == 'bxgy':
-            for key in ['buy_products', 'get_products']:
-                if key not in details or not isinstance(details[key], list) or not details[key]:
-                    raise HTTPException(status_code=400, detail=f"{key} must be a non-empty list")
-            for buy in details['buy_products']:
-                if not isinstance(buy, dict) or 'product_id' not in buy or 'quantity' not in buy:
-                    raise HTTPException(status_code=400, detail="Each buy_product must have product_id and quantity")
-                if not isinstance(buy['product_id'], int) or buy['product_id'] <= 0:
-                    raise HTTPException(status_code=400, detail="product_id in buy_products must be a positive integer")
-                if not isinstance(buy['quantity'], int) or buy['quantity'] <= 0:
-                    raise HTTPException(status_code=400, detail="quantity in buy_products must be a positive integer")
-            for get in details['get_products']:
-                if not isinstance(get, dict) or 'product_id' not in get or 'quantity' not in get:
-                    raise HTTPException(status_code=400, detail="Each get_product must have product_id and quantity")
-                if not isinstance(get['product_id'], int) or get['product_id'] <= 0:
-                    raise HTTPException(status_code=400, detail="product_id in get_products must be a positive integer")
-                if not isinstance(get['quantity'], int) or get['quantity'] <= 0:
-                    raise HTTPException(status_code=400, detail="quantity in get_products must be a positive integer")
-            if 'repetition_limit' in details:
-                if not isinstance(details['repetition_limit'], int) or details['repetition_limit'] <= 0:
-                    raise HTTPException(status_code=400, detail="repetition_limit must be a positive integer")
-        else:
+        model = _DETAILS_MODELS.get(coupon_type)
+        if model is None:
             raise HTTPException(status_code=400, detail=f"Unsupported coupon type: {coupon_type}")
+        try:
+            model.model_validate(details, strict=True)
+        except ValidationError as e:
+            raise HTTPException(
+                status_code=400,
+                detail=e.errors(include_url=False, include_context=False, include_input=False),
+            )
 
     @staticmethod
     def ensure_redeemable(coupon: Coupon) -> None:
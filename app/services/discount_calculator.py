@@ -1,134 +1,272 @@
 
-from typing import Dict, Tuple
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Protocol, Tuple
 from decimal import Decimal, ROUND_HALF_UP, getcontext
-from app.schemas.coupon import Cart, CouponResponse
+import numpy as np
+from cachetools import LRUCache
+from app.schemas.coupon import Cart
 
 getcontext().prec = 28
 
 
 def D(x) -> Decimal:
+    # Only floats need the str() round-trip; ints and Decimals convert exactly
+    if type(x) is Decimal:
+        return x
+    if type(x) is int:
+        return Decimal(x)
     return Decimal(str(x))
 
 
-def round2(x: Decimal) -> Decimal:
-    return x.quantize(Decimal('0.01'), rounding=ROUND_HALF_UP)
+def to_cents(x) -> int:
+    # Round half-up once at the boundary; everything after this is int math
+    # to_integral_value, unlike quantize, isn't limited to the context precision
+    return int((D(x) * 100).to_integral_value(rounding=ROUND_HALF_UP))
+
+
+def from_cents(cents: int) -> float:
+    return cents / 100
+
+
+def div_half_up(num: int, den: int) -> int:
+    return (2 * num + den) // (2 * den)
+
+
+_INT64_MAX = int(np.iinfo(np.int64).max)
+
+
+def _int_array(values: List[int], fits: bool = True) -> np.ndarray:
+    """int64 when the values fit, else an object array of Python ints, which can't overflow"""
+    if fits and all(-_INT64_MAX <= v <= _INT64_MAX for v in values):
+        return np.array(values, dtype=np.int64)
+    return np.array(values, dtype=object)
+
+
+class _CartArrays(NamedTuple):
+    """Cart items as parallel integer arrays (structure of arrays); int64 unless a
+    cart is large enough to overflow it"""
+    pids: np.ndarray
+    qtys: np.ndarray
+    prices: np.ndarray    # unit price in cents
+
+
+@dataclass(frozen=True)
+class CartIndex:
+    """Per-request view of the cart, built once and shared by every coupon check"""
+    cart: Cart
+    arrays: _CartArrays
+    by_pid: _CartArrays               # sorted unique pids; last occurrence's qty and price
+    pid_line_total: Dict[int, int]    # first occurrence
+    cart_total_cents: int
+
+
+class CouponLike(Protocol):
+    """ORM row or cached ActiveCoupon; only these fields are read"""
+    id: int
+    version: int
+    type: str
+    details: Dict[str, Any]
+
+
+# Compiled coupon: discount in cents for a cart, or None when the coupon doesn't apply
+CompiledCoupon = Callable[[CartIndex], Optional[int]]
+
+# coupon id -> (version, type, details, compiled coupon)
+_compiled: LRUCache = LRUCache(maxsize=4096)
+
+
+def _lookup(by_pid: _CartArrays, ids: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Positions of `ids` in the sorted cart pids, and which of them are in the cart"""
+    pos = np.minimum(np.searchsorted(by_pid.pids, ids), len(by_pid.pids) - 1)
+    return pos, by_pid.pids[pos] == ids
 
 
 class DiscountCalculator:
-    """Service class to calculate discounts for different coupon types"""
+    """Service class to calculate discounts for different coupon types.
+
+    Amounts are integer cents; the cart is indexed once per request with
+    `index_cart`, and each coupon's details are compiled once per version
+    into a function of that `CartIndex` (`compile_coupon`).
+    """
+
+    @staticmethod
+    def cart_arrays(cart: Cart) -> _CartArrays:
+        items = cart.items
+        pids = [it.product_id for it in items]
+        qtys = [it.quantity for it in items]
+        prices = [to_cents(it.price) for it in items]
+        # One dtype for all three so the arithmetic between them doesn't mix; int64
+        # only while the cart total and the summed quantities fit in it
+        fits = (
+            sum(q * p for q, p in zip(qtys, prices)) <= _INT64_MAX
+            and sum(qtys) <= _INT64_MAX
+            and max(pids, default=0) <= _INT64_MAX
+        )
+        return _CartArrays(
+            pids=_int_array(pids, fits),
+            qtys=_int_array(qtys, fits),
+            prices=_int_array(prices, fits),
+        )
 
     @staticmethod
-    def calculate_cart_total(cart: Cart) -> Decimal:
-        return sum(D(item.quantity) * D(item.price) for item in cart.items)
+    def index_cart(cart: Cart) -> CartIndex:
+        arrays = DiscountCalculator.cart_arrays(cart)
+        pids, qtys, prices = arrays
+        pid_line_total: Dict[int, int] = {}
+        for pid, qty, price in zip(pids.tolist(), qtys.tolist(), prices.tolist()):
+            pid_line_total.setdefault(pid, qty * price)
+        # first index in the reversed cart = last occurrence in the cart
+        unique_pids, rev_idx = np.unique(pids[::-1], return_index=True)
+        last = len(pids) - 1 - rev_idx
+        return CartIndex(
+            cart=cart,
+            arrays=arrays,
+            by_pid=_CartArrays(pids=unique_pids, qtys=qtys[last], prices=prices[last]),
+            pid_line_total=pid_line_total,
+            cart_total_cents=int((qtys * prices).sum()),
+        )
 
     @staticmethod
-    def calculate_cart_wise_discount(cart: Cart, coupon_details: dict) -> Decimal:
-        cart_total = DiscountCalculator.calculate_cart_total(cart)
-        threshold = D(coupon_details.get('threshold', 0))
-        discount = D(coupon_details.get('discount', 0))
-        discount_type = coupon_details.get('discount_type', 'percentage')
-
-        if cart_total < threshold:
-            return D(0)
-        if discount_type == 'percentage':
-            return round2((cart_total * discount) / D(100))
+    def distribute(index: CartIndex, total_discount: int) -> List[int]:
+        """Split a cart-level discount across items by line value, rounding half-up;
+        the last item takes the remainder so the parts sum to the total"""
+        qtys, prices = index.arrays.qtys, index.arrays.prices
+        total = index.cart_total_cents
+        # 2 * discount * line_total + total is at most this; a discount can exceed the
+        # cart total (percentages above 100), so check it rather than the total alone
+        if 2 * total_discount * total + total > _INT64_MAX:
+            qtys, prices = qtys.astype(object), prices.astype(object)
+        if total <= 0:
+            parts = np.zeros(len(qtys), dtype=qtys.dtype)
         else:
-            return min(round2(discount), cart_total)
+            parts = (2 * total_discount * qtys * prices + total) // (2 * total)
+        if len(parts):
+            parts[-1] = total_discount - int(parts[:-1].sum())
+        return parts.tolist()
 
     @staticmethod
-    def calculate_product_wise_discount(cart: Cart, coupon_details: dict) -> Decimal:
+    def _compile_cart_wise(coupon_details: dict) -> CompiledCoupon:
+        threshold = to_cents(coupon_details.get('threshold', 0))
+        # cents for fixed, hundredths of a percent for percentage
+        discount = to_cents(coupon_details.get('discount', 0))
+        percentage = coupon_details.get('discount_type', 'percentage') == 'percentage'
+
+        def apply(index: CartIndex) -> Optional[int]:
+            cart_total = index.cart_total_cents
+            if cart_total < threshold:
+                return None
+            if percentage:
+                return div_half_up(cart_total * discount, 10000)
+            return min(discount, cart_total)
+
+        return apply
+
+    @staticmethod
+    def _compile_product_wise(coupon_details: dict) -> CompiledCoupon:
         product_id = coupon_details.get('product_id')
-        discount = D(coupon_details.get('discount', 0))
-        discount_type = coupon_details.get('discount_type', 'percentage')
+        discount = to_cents(coupon_details.get('discount', 0))
+        percentage = coupon_details.get('discount_type', 'percentage') == 'percentage'
 
-        target_item = next((it for it in cart.items if it.product_id == product_id), None)
-        if not target_item:
-            return D(0)
+        def apply(index: CartIndex) -> Optional[int]:
+            product_total = index.pid_line_total.get(product_id)
+            if product_total is None:
+                return None
+            if percentage:
+                return div_half_up(product_total * discount, 10000)
+            return min(discount, product_total)
 
-        product_total = D(target_item.quantity) * D(target_item.price)
-        if discount_type == 'percentage':
-            return round2((product_total * discount) / D(100))
-        else:
-            return min(round2(discount), product_total)
+        return apply
 
     @staticmethod
-    def calculate_bxgy_discount(cart: Cart, coupon_details: dict) -> Tuple[Decimal, Dict[int, int]]:
+    def _bxgy_plan(coupon_details: dict) -> Callable[[CartIndex], Optional[Tuple[int, Dict[int, int]]]]:
         buy_products = coupon_details.get('buy_products', [])
+        buy_ids = _int_array([b.get('product_id') for b in buy_products])
+        required = sum(b.get('quantity') for b in buy_products)
         get_products = coupon_details.get('get_products', [])
+        get_ids = _int_array([g.get('product_id') for g in get_products])
+        # Python ints: free quantity * times * price is unbounded
+        get_qtys = np.array([g.get('quantity') for g in get_products], dtype=object)
         repetition_limit = coupon_details.get('repetition_limit', 1)
 
-        cart_items = {item.product_id: item for item in cart.items}
-
-        total_buy_quantity = 0
-        required_buy_quantity = 0
-        for buy_product in buy_products:
-            product_id = buy_product.get('product_id')
-            required_quantity = buy_product.get('quantity')
-            required_buy_quantity += required_quantity
-            if product_id in cart_items:
-                total_buy_quantity += cart_items[product_id].quantity
+        def plan(index: CartIndex) -> Optional[Tuple[int, Dict[int, int]]]:
+            by_pid = index.by_pid
+            if required == 0 or not len(by_pid.pids):
+                return None
+            pos, in_cart = _lookup(by_pid, buy_ids)
+            total_buy = int(np.where(in_cart, by_pid.qtys[pos], 0).sum())
+            times_applicable = min(total_buy // required, repetition_limit)
+            # applicable once the buy side is satisfied at least one time
+            if times_applicable == 0:
+                return None
 
-        if required_buy_quantity == 0:
-            return D(0), {}
+            free_qtys = get_qtys * times_applicable
+            granted = free_qtys > 0
+            # If the GET product is in cart, discount those; if not, we still grant free items by adding them.
+            # Without a catalog price, items not in the cart count as 0 (router adds them at price 0).
+            pos, in_cart = _lookup(by_pid, get_ids)
+            prices = np.where(in_cart & granted, by_pid.prices[pos], 0)
+            total_discount = int((free_qtys * prices).sum())
+            free_items = dict(zip(get_ids[granted].tolist(), free_qtys[granted].tolist()))
+            return total_discount, free_items
 
-        times_applicable = min(total_buy_quantity // required_buy_quantity, repetition_limit)
+        return plan
 
-        free_items: Dict[int, int] = {}
-        total_discount = D(0)
-
-        for get_product in get_products:
-            product_id = get_product.get('product_id')
-            free_quantity_per_application = get_product.get('quantity')
+    @staticmethod
+    def _compile_bxgy(coupon_details: dict) -> CompiledCoupon:
+        plan = DiscountCalculator._bxgy_plan(coupon_details)
 
-            total_free_quantity = free_quantity_per_application * times_applicable
+        def apply(index: CartIndex) -> Optional[int]:
+            planned = plan(index)
+            return planned[0] if planned is not None else None
 
-            # If the GET product is in cart, discount those; if not, we still grant free items by adding them
-            if product_id in cart_items:
-                item_price = D(cart_items[product_id].price)
-            else:
-                # If not in cart, assume a price of 0 for discount purposes (cannot compute without catalog).
-                # We will add the free items with price as provided when applying coupon (router will set price=0 for added free items).
-                item_price = D(0)
+        return apply
 
-            if total_free_quantity > 0:
-                free_items[product_id] = total_free_quantity
-                total_discount += D(total_free_quantity) * item_price
+    @staticmethod
+    def calculate_bxgy_discount(index: CartIndex, coupon_details: dict) -> Tuple[int, Dict[int, int]]:
+        planned = DiscountCalculator._bxgy_plan(coupon_details)(index)
+        return planned if planned is not None else (0, {})
 
-        return round2(total_discount), free_items
+    @staticmethod
+    def compile_coupon(coupon: CouponLike) -> CompiledCoupon:
+        cached = _compiled.get(coupon.id)
+        # Ids can be reused after a delete (SQLite) and another worker may have handled
+        # the delete, so type and details must match too; the identity check keeps
+        # cached active coupons from paying for a deep compare
+        if (
+            cached is not None
+            and cached[0] == coupon.version
+            and cached[1] == coupon.type
+            and (cached[2] is coupon.details or cached[2] == coupon.details)
+        ):
+            return cached[3]
+        compiler = _COMPILERS.get(coupon.type)
+        try:
+            compiled = compiler(coupon.details) if compiler else _not_applicable
+        except (ArithmeticError, TypeError, ValueError):
+            # A malformed stored row (e.g. one saved before validation) must not fail every cart
+            compiled = _not_applicable
+        _compiled[coupon.id] = (coupon.version, coupon.type, coupon.details, compiled)
+        return compiled
 
     @staticmethod
-    def is_coupon_applicable(cart: Cart, coupon: CouponResponse) -> bool:
-        # Basic active/expiry checks are handled at service layer; here we check logical applicability
-        if coupon.type == 'cart-wise':
-            cart_total = DiscountCalculator.calculate_cart_total(cart)
-            threshold = D(coupon.details.get('threshold', 0))
-            return cart_total >= threshold
-        elif coupon.type == 'product-wise':
-            product_id = coupon.details.get('product_id')
-            return any(item.product_id == product_id for item in cart.items)
-        elif coupon.type == 'bxgy':
-            buy_products = coupon.details.get('buy_products', [])
-            cart_items = {item.product_id: item for item in cart.items}
-            total_buy_quantity = 0
-            required_buy_quantity = 0
-            for buy_product in buy_products:
-                product_id = buy_product.get('product_id')
-                required_quantity = buy_product.get('quantity')
-                required_buy_quantity += required_quantity
-                if product_id in cart_items:
-                    total_buy_quantity += cart_items[product_id].quantity
-            return required_buy_quantity > 0 and total_buy_quantity >= required_buy_quantity
-        return False
+    def evict_compiled(coupon_id: Optional[int] = None) -> None:
+        if coupon_id is None:
+            _compiled.clear()
+        else:
+            _compiled.pop(coupon_id, None)
 
     @staticmethod
-    def calculate_discount(cart: Cart, coupon: CouponResponse) -> Decimal:
-        if not DiscountCalculator.is_coupon_applicable(cart, coupon):
-            return D(0)
-        if coupon.type == 'cart-wise':
-            return DiscountCalculator.calculate_cart_wise_discount(cart, coupon.details)
-        elif coupon.type == 'product-wise':
-            return DiscountCalculator.calculate_product_wise_discount(cart, coupon.details)
-        elif coupon.type == 'bxgy':
-            discount, _ = DiscountCalculator.calculate_bxgy_discount(cart, coupon.details)
-            return discount
-        return D(0)
+    def calculate_discount(index: CartIndex, coupon: CouponLike) -> int:
+        return DiscountCalculator.compile_coupon(coupon)(index) or 0
+
+
+def _not_applicable(index: CartIndex) -> Optional[int]:
+    return None
+
+
+# Coupon type -> compiler from details to a CompiledCoupon
+_COMPILERS: Dict[str, Callable[[dict], CompiledCoupon]] = {
+    'cart-wise': DiscountCalculator._compile_cart_wise,
+    'product-wise': DiscountCalculator._compile_product_wise,
+    'bxgy': DiscountCalculator._compile_bxgy,
+}
@@ -0,0 +1,76 @@
+import os
+from dotenv import load_dotenv
+from sqlalchemy import create_engine, text
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import NullPool
+
+# Runs before anything imports the app. Load .env so TEST_DATABASE_URL can be read
+# from it, unless CI already exported it
+if "TEST_DATABASE_URL" not in os.environ:
+    load_dotenv(override=False)
+# app.database builds its engine from DATABASE_URL at import (here via app.models,
+# and in test_coupons.py); the tests never connect through it, so any async URL
+# will do when it isn't configured
+os.environ.setdefault("DATABASE_URL", "sqlite+aiosqlite:///./coupons.db")
+
+
+def _admin_engine(url):
+    # CREATE/DROP DATABASE can't run in a transaction; connect to the maintenance DB
+    return create_engine(
+        url.set(database="postgres"), isolation_level="AUTOCOMMIT", poolclass=NullPool
+    )
+
+
+def _build_template(url, template):
+    from app.models import coupon as coupon_model
+
+    admin = _admin_engine(url)
+    quote = admin.dialect.identifier_preparer.quote
+    with admin.connect() as conn:
+        conn.execute(text(f"DROP DATABASE IF EXISTS {quote(template)}"))
+        conn.execute(text(f"CREATE DATABASE {quote(template)}"))
+    admin.dispose()
+
+    template_engine = create_engine(
+        url.set(database=template),
+        connect_args={"options": "-c synchronous_commit=off"},  # throwaway, like the test DBs
+        poolclass=NullPool,
+    )
+    coupon_model.Base.metadata.create_all(template_engine)
+    template_engine.dispose()  # a template can't be copied while connected
+
+
+def _clone_template(url, template, database):
+    admin = _admin_engine(url)
+    quote = admin.dialect.identifier_preparer.quote
+    with admin.connect() as conn:
+        conn.execute(text(f"DROP DATABASE IF EXISTS {quote(database)} WITH (FORCE)"))
+        conn.execute(text(f"CREATE DATABASE {quote(database)} TEMPLATE {quote(template)}"))
+    admin.dispose()
+
+
+def pytest_configure(config):
+    """Give each pytest process its own Postgres database, cloned from a template.
+
+    The schema goes into `<db>_template` once per run (in the xdist controller, or
+    the only process without xdist); each process that runs tests then gets
+    `<db>_<worker>` via CREATE DATABASE ... TEMPLATE, which copies the catalog
+    instead of replaying the DDL. test_coupons.py connects to the same name.
+    Only used with USE_PG_TESTS=1; the default in-memory SQLite run creates its
+    schema in test_coupons.py.
+    """
+    test_url = os.getenv("TEST_DATABASE_URL")
+    if os.getenv("USE_PG_TESTS") != "1" or not test_url or make_url(test_url).get_backend_name() != "postgresql":
+        return
+
+    # Sync psycopg driver; the DDL here doesn't need the app's async engine
+    url = make_url(test_url).set(drivername="postgresql+psycopg")
+    template = f"{url.database}_template"
+
+    if not hasattr(config, "workerinput"):
+        _build_template(url, template)
+        if config.getoption("numprocesses", default=None):
+            return  # xdist controller; the workers clone their own databases
+
+    worker_id = os.environ.get("PYTEST_XDIST_WORKER", "gw0")
+    _clone_template(url, template, f"{url.database}_{worker_id}")